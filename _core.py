@@ -0,0 +1,284 @@
+"""
+Zoom出席カウント 共通処理
+Webアプリ版（app.py）とデスクトップ版（zoom_attendance.py）で共有する
+"""
+
+import base64
+import hashlib
+import io
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+
+# 既定のモデル（環境変数ZOOM_ATTEND_MODELで変更可能）
+DEFAULT_MODEL = 'gpt-4o-mini'
+
+# 出力トークンの上限（参加者50人 × 1人あたり約8トークン）
+MAX_OUTPUT_TOKENS = 400
+
+# APIに送る画像の長辺の上限（px）
+MAX_IMAGE_SIZE = 1024
+
+# JPEGの画質の候補（高い順）と、画像データの目安の上限（バイト）
+JPEG_QUALITIES = (85, 70, 55)
+MAX_JPEG_BYTES = 100_000
+
+# 画像の解析モード。参加者パネルの文字は大きくはっきりしているので、
+# タイル分割されない"low"で十分（画像1枚あたりの入力トークンが一定になる）
+IMAGE_DETAIL = "low"
+
+# 同時に送るAPIリクエストの上限
+MAX_CONCURRENT_REQUESTS = 5
+
+# APIリクエストのタイムアウト（秒）と、レート制限・タイムアウト時の再試行回数
+# （指数バックオフはSDKが行う）
+REQUEST_TIMEOUT = 30.0
+MAX_RETRIES = 3
+
+# 記録時刻の表示形式
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# 解析結果をキャッシュする画像の数
+CACHE_SIZE = 128
+
+# 参加者名抽出の指示文
+# プロンプトキャッシュが効くよう、毎回同じ内容で先頭（systemメッセージ）に置く
+PROMPT = """この画像はZoomミーティングの参加者パネルのスクリーンショットです。
+参加者の名前のみを抽出してください。
+
+ルール:
+- 1行に1人の名前を出力
+- 名前の後ろにある「(ホスト)」「(自分)」「(me)」「(host)」などの表記は除去
+- 「ミュート」「ビデオ」などのUIボタンは無視
+- アイコンや絵文字は無視
+- 名前が読み取れない場合は出力しない
+
+出力形式（名前のみ、余計な説明は不要）:
+山田太郎
+John Smith
+..."""
+
+# モデルの出力を囲むコードブロックの記号
+_FENCE_RE = re.compile(r"^```[a-z]*\n|\n```$", re.M)
+
+# 名前の後ろに付く「(ホスト)」「(自分)」などの表記
+_ANNOTATION = r"(?:共同ホスト|ホスト|自分|ゲスト|co-?host|host|me|you|guest)"
+_ANNOT_RE = re.compile(rf"\s*[（(]{_ANNOTATION}(?:\s*[、,]\s*{_ANNOTATION})*[)）]\s*$", re.I)
+
+# 行頭の箇条書きの記号・番号
+_BULLET_RE = re.compile(r"^(?:[-*・•]\s*|\d+[.)．]\s+)")
+
+
+def preprocess(image):
+    """余白を切り取り、縮小してJPEGに再エンコード（コピーを避けるためmemoryviewで返す）
+
+    imageには画像ファイルのバイト列かPILの画像を渡す
+    """
+    # PILとpandasはimportに時間がかかるので、起動を速くするため使う関数の中でimportする
+    from PIL import Image, ImageChops
+
+    if not isinstance(image, Image.Image):
+        image = Image.open(io.BytesIO(image))
+    image = image.convert('RGB')
+
+    # 左上のピクセルと同じ色の余白を切り取る
+    background = Image.new('RGB', image.size, image.getpixel((0, 0)))
+    bbox = ImageChops.difference(image, background).getbbox()
+    if bbox:
+        image = image.crop(bbox)
+
+    image.thumbnail((MAX_IMAGE_SIZE, MAX_IMAGE_SIZE), Image.LANCZOS)
+
+    # 上限に収まるまで画質を下げる（文字だけのパネルなら低めの画質でも読める）
+    for quality in JPEG_QUALITIES:
+        buffer = io.BytesIO()
+        image.save(buffer, format='JPEG', quality=quality, optimize=True)
+        if buffer.tell() < MAX_JPEG_BYTES:
+            break
+
+    return buffer.getbuffer()
+
+
+def build_request(jpeg_bytes):
+    """Chat Completions APIのリクエスト本体を作成"""
+    image_base64 = base64.b64encode(jpeg_bytes).decode('ascii')
+
+    return {
+        "model": os.environ.get('ZOOM_ATTEND_MODEL', DEFAULT_MODEL),
+        "messages": [
+            {"role": "system", "content": PROMPT},
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": f"data:image/jpeg;base64,{image_base64}",
+                            "detail": IMAGE_DETAIL
+                        }
+                    }
+                ]
+            }
+        ],
+        "max_tokens": MAX_OUTPUT_TOKENS,
+        "temperature": 0
+    }
+
+
+def parse_names(text):
+    """モデルの出力から名前のリストを取り出す"""
+    text = _FENCE_RE.sub('', text.strip())
+    names = (_ANNOT_RE.sub('', _BULLET_RE.sub('', line.strip())) for line in text.splitlines())
+
+    # 「Here are the names:」のような前置きを除外し、重複を除去しつつ順序を保持
+    return list(dict.fromkeys(
+        name for name in names if 2 <= len(name) <= 80 and not name.endswith((':', '：'))
+    ))
+
+
+def _names_from_output(content, finish_reason):
+    """モデルの出力から(名前のリスト, 打ち切られたか)を取り出す
+
+    出力が上限で打ち切られた場合、最後の行は途中で切れているので捨てる
+    """
+    truncated = finish_reason == 'length'
+    if truncated:
+        content = content.rpartition('\n')[0]
+
+    return parse_names(content), truncated
+
+
+class NameCache:
+    """解析結果のキャッシュ（画像のハッシュ値 → 名前、古いものから破棄）
+
+    ワーカースレッドから同時に使われるのでロックで保護する
+    """
+
+    def __init__(self, maxsize=CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, digest):
+        with self._lock:
+            names = self._entries.get(digest)
+            if names is not None:
+                self._entries.move_to_end(digest)
+            return names
+
+    def put(self, digest, names):
+        with self._lock:
+            self._entries[digest] = tuple(names)
+            self._entries.move_to_end(digest)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+
+def extract_names(client, jpeg_bytes, cache=None):
+    """OpenAIの画像解析で参加者名を抽出し、(名前のリスト, 打ち切られたか)を返す
+
+    jpeg_bytesにはpreprocess()の結果を渡す。
+    cacheにNameCacheを渡すと、同じ画像はAPIを呼ばずにキャッシュを使う。
+    出力が上限で打ち切られた場合は参加者の一部が欠けている
+    """
+    digest = hashlib.blake2b(jpeg_bytes, digest_size=16).digest()
+    if cache is not None:
+        names = cache.get(digest)
+        if names is not None:
+            return list(names), False
+
+    response = client.chat.completions.create(**build_request(jpeg_bytes))
+    choice = response.choices[0]
+    names, truncated = _names_from_output(choice.message.content, choice.finish_reason)
+
+    # 上限で打ち切られた不完全な結果はキャッシュしない
+    if cache is not None and not truncated:
+        cache.put(digest, names)
+
+    return names, truncated
+
+
+def submit_batch(client, images):
+    """Batch APIで複数の画像の解析を依頼し、バッチのIDを返す
+
+    imagesにはpreprocess()の結果を渡す。結果はcollect_batch()で受け取る。
+    通常の呼び出しより料金が半額になる代わりに、完了まで最大24時間かかる
+    """
+    lines = [
+        json.dumps({
+            "custom_id": f"img-{i}",
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": build_request(jpeg_bytes)
+        }, ensure_ascii=False)
+        for i, jpeg_bytes in enumerate(images)
+    ]
+
+    batch_file = client.files.create(
+        file=("zoom_attendance_batch.jsonl", "\n".join(lines).encode('utf-8')),
+        purpose='batch'
+    )
+    batch = client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint='/v1/chat/completions',
+        completion_window='24h'
+    )
+    return batch.id
+
+
+def collect_batch(client, batch_id):
+    """submit_batch()で依頼したバッチの結果を受け取る
+
+    まだ完了していなければNoneを返す。完了していれば(画像ごとの名前のリスト,
+    出力が上限で打ち切られた画像の数)を返し、解析に失敗した画像の分はNoneになる
+    """
+    batch = client.batches.retrieve(batch_id)
+
+    if batch.status in ('failed', 'expired', 'cancelled'):
+        raise RuntimeError(f"バッチ処理が完了しませんでした（状態: {batch.status}）")
+    if batch.status != 'completed':
+        return None
+
+    # 出力は順不同なのでcustom_idで画像と対応付ける
+    results = [None] * batch.request_counts.total
+    truncated_count = 0
+    if batch.output_file_id:
+        for line in client.files.content(batch.output_file_id).text.splitlines():
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            response = item.get('response')
+            if item.get('error') or not response or response['status_code'] != 200:
+                continue
+
+            i = int(item['custom_id'].removeprefix('img-'))
+            choice = response['body']['choices'][0]
+            results[i], truncated = _names_from_output(
+                choice['message']['content'], choice['finish_reason']
+            )
+            truncated_count += truncated
+
+    return results, truncated_count
+
+
+def summarize(records):
+    """(名前, UNIX時刻)の記録から名前ごとの集計表を作る"""
+    import pandas as pd  # preprocess()と同じく遅延import
+
+    # 記録は解析の完了順に並んでいることがあるので、時刻順に並べ替える
+    df = pd.DataFrame(records, columns=['名前', 'ts']).sort_values('ts', kind='stable')
+
+    # 同じ時刻の記録が多いので、時刻の文字列化は重複を除いた時刻ごとに1回だけ行う
+    # （記録時点の夏時間を反映するため、現在のUTCオフセットではなくfromtimestampを使う）
+    formatted = {ts: datetime.fromtimestamp(ts).strftime(TIME_FORMAT) for ts in df['ts'].unique()}
+    df['時刻'] = df['ts'].map(formatted)
+
+    return df.groupby('名前', sort=True).agg(
+        初回記録時刻=('時刻', 'min'),
+        記録回数=('時刻', 'size'),
+        全記録時刻=('時刻', '; '.join)
+    ).reset_index()
@@ -4,77 +4,98 @@ Zoomの参加者パネルのスクリーンショットから出席者を抽出
 """
 
 import streamlit as st
-import pandas as pd
-import base64
 import io
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from openai import OpenAI
+from _core import (
+    MAX_CONCURRENT_REQUESTS, MAX_RETRIES, REQUEST_TIMEOUT, NameCache, collect_batch,
+    extract_names, preprocess, submit_batch, summarize
+)
 
 
 def get_openai_client():
-    """OpenAIクライアントを取得（環境変数から）"""
+    """OpenAIクライアントを取得（環境変数から）
+
+    接続（TLS・HTTP/2）を使い回すため、APIキーごとにセッション内で保持する
+    """
     # Streamlit Cloudのsecretsまたは環境変数から取得
     api_key = st.secrets.get("OPENAI_API_KEY", None) if hasattr(st, 'secrets') else None
     if not api_key:
         api_key = os.environ.get('OPENAI_API_KEY')
 
-    if api_key:
-        return OpenAI(api_key=api_key)
-    return None
-
-
-def extract_names_with_openai(client, image_bytes):
-    """OpenAI GPT-4oで参加者名を抽出"""
-    image_base64 = base64.b64encode(image_bytes).decode('utf-8')
-
-    response = client.chat.completions.create(
-        model="gpt-4o",
-        messages=[
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": """この画像はZoomミーティングの参加者パネルのスクリーンショットです。
-参加者の名前のみを抽出してください。
-
-ルール:
-- 1行に1人の名前を出力
-- 名前の後ろにある「(ホスト)」「(自分)」「(me)」「(host)」などの表記は除去
-- 「ミュート」「ビデオ」などのUIボタンは無視
-- アイコンや絵文字は無視
-- 名前が読み取れない場合は出力しない
-
-出力形式（名前のみ、余計な説明は不要）:
-山田太郎
-John Smith
-..."""
-                    },
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/png;base64,{image_base64}"
-                        }
-                    }
-                ]
-            }
-        ],
-        max_tokens=1000
-    )
+    if not api_key:
+        return None
+
+    if st.session_state.get('_client_key') != api_key:
+        import httpx
+        from openai import DefaultHttpxClient, OpenAI
+
+        # APIキーが変わった場合は古いクライアントの接続を閉じる
+        if st.session_state.get('_client') is not None:
+            st.session_state._client.close()
+
+        st.session_state._client = OpenAI(
+            api_key=api_key,
+            timeout=REQUEST_TIMEOUT,
+            max_retries=MAX_RETRIES,
+            http_client=DefaultHttpxClient(
+                http2=True,
+                limits=httpx.Limits(max_keepalive_connections=10)
+            )
+        )
+        st.session_state._client_key = api_key
+
+    return st.session_state._client
+
+
+def _extract_one(client, image_bytes, cache):
+    """1枚の画像を解析する（失敗した場合は(None, False)を返し、他の画像の結果は残す）"""
+    try:
+        return extract_names(client, preprocess(image_bytes), cache=cache)
+    except Exception:
+        return None, False
+
+
+def extract_names_concurrently(client, images, cache):
+    """複数の画像を並列に解析し、(画像ごとの名前のリスト, 出力が打ち切られた画像の数)を返す
+
+    解析に失敗した画像の分はNoneになる
+    """
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
+        outputs = list(executor.map(
+            lambda image_bytes: _extract_one(client, image_bytes, cache),
+            images
+        ))
+
+    return [names for names, _ in outputs], sum(truncated for _, truncated in outputs)
+
 
-    text = response.choices[0].message.content.strip()
-    names = [line.strip() for line in text.split('\n') if line.strip()]
+def _warn_truncated(truncated):
+    """出力が上限で打ち切られた画像があれば警告を表示"""
+    if truncated:
+        st.warning(
+            f"⚠️ {truncated}枚の画像で参加者が多く、AIの出力が途中で切れました。"
+            "一部の参加者が記録されていない可能性があります。範囲を分けて撮影してください。"
+        )
 
-    # 重複を除去しつつ順序を保持
-    seen = set()
-    unique_names = []
-    for name in names:
-        if name and name not in seen and len(name) >= 2:
-            seen.add(name)
-            unique_names.append(name)
 
-    return unique_names
+def _record_results(results, timestamp):
+    """画像ごとの名前のリストを出席データに追加し、(検出人数, 新規人数)を返す
+
+    画像1枚ごとに1回の記録としてカウントし、解析に失敗した画像（None）は飛ばす
+    """
+    known = {name for name, _ in st.session_state.records}
+    detected = set()
+
+    for names in results:
+        if names is None:
+            continue
+        st.session_state.records.extend((name, timestamp) for name in names)
+        detected.update(names)
+
+    return len(detected), len(detected - known)
 
 
 def main():
@@ -95,8 +116,12 @@ def main():
         return
 
     # セッション状態の初期化
-    if 'attendance_data' not in st.session_state:
-        st.session_state.attendance_data = {}
+    if 'records' not in st.session_state:
+        st.session_state.records = []  # [(名前, UNIX時刻)]
+    if 'name_cache' not in st.session_state:
+        st.session_state.name_cache = NameCache()
+    if 'pending_batches' not in st.session_state:
+        st.session_state.pending_batches = {}  # {バッチID: {'count', 'submitted_at'}}
 
     # サイドバー: 使い方
     with st.sidebar:
@@ -113,80 +138,128 @@ def main():
         st.markdown("""
         - 参加者パネルを大きく表示すると認識精度が上がります
         - 複数回アップロードすると出席回数がカウントされます
+        - 複数の画像をまとめてアップロードすると並列で解析します
         """)
 
-    # ファイルアップロード
-    uploaded_file = st.file_uploader(
+    # ファイルアップロード（複数可）
+    uploaded_files = st.file_uploader(
         "参加者パネルのスクリーンショットをアップロード",
         type=['png', 'jpg', 'jpeg'],
-        help="Zoomの参加者パネルを含むスクリーンショットをアップロードしてください"
+        accept_multiple_files=True,
+        help="Zoomの参加者パネルを含むスクリーンショットをアップロードしてください（複数選択可）"
     )
 
-    if uploaded_file:
+    if uploaded_files:
         # 画像プレビュー
         col1, col2 = st.columns([1, 1])
 
         with col1:
-            st.image(uploaded_file, caption="アップロードした画像", use_container_width=True)
+            st.image(
+                uploaded_files,
+                caption=[f.name for f in uploaded_files],
+                use_container_width=True
+            )
 
         with col2:
-            if st.button("🔍 解析する", type="primary", use_container_width=True):
-                with st.spinner("AIが参加者を解析中..."):
-                    try:
-                        image_bytes = uploaded_file.getvalue()
-                        names = extract_names_with_openai(client, image_bytes)
-
-                        if names:
-                            now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                            new_count = 0
-
-                            for name in names:
-                                if name not in st.session_state.attendance_data:
-                                    st.session_state.attendance_data[name] = []
-                                    new_count += 1
-                                st.session_state.attendance_data[name].append(now)
-
-                            st.success(f"✅ {len(names)}人検出（新規: {new_count}人）")
-                        else:
-                            st.warning("参加者が検出されませんでした。画像を確認してください。")
+            use_batch = st.checkbox(
+                "バッチ処理で解析する",
+                help="料金が半額になりますが、完了まで最大24時間かかります。録画から撮った大量の画像向けです。"
+            )
 
-                    except Exception as e:
-                        st.error(f"エラーが発生しました: {str(e)}")
+            if st.button("🔍 解析する", type="primary", use_container_width=True):
+                images = [f.getvalue() for f in uploaded_files]
+
+                if use_batch:
+                    with st.spinner("バッチ処理を依頼中..."):
+                        try:
+                            batch_id = submit_batch(
+                                client, [preprocess(image_bytes) for image_bytes in images]
+                            )
+                            st.session_state.pending_batches[batch_id] = {
+                                'count': len(images),
+                                'submitted_at': time.time()
+                            }
+                        except Exception as e:
+                            st.error(f"エラーが発生しました: {str(e)}")
+                else:
+                    with st.spinner("AIが参加者を解析中..."):
+                        try:
+                            results, truncated = extract_names_concurrently(
+                                client, images, st.session_state.name_cache
+                            )
+                            detected, new_count = _record_results(results, time.time())
+                            failed = sum(1 for names in results if names is None)
+
+                            if detected:
+                                st.success(f"✅ {len(images)}枚から{detected}人検出（新規: {new_count}人）")
+                            elif failed < len(images):
+                                st.warning("参加者が検出されませんでした。画像を確認してください。")
+                            if failed:
+                                st.warning(f"{failed}枚の画像の解析に失敗しました。")
+                            _warn_truncated(truncated)
+
+                        except Exception as e:
+                            st.error(f"エラーが発生しました: {str(e)}")
+
+    # 実行中のバッチ処理（ページを開き直した場合はIDを貼り付けて再開できる）
+    with st.expander("🗂️ バッチ処理の結果を受け取る"):
+        resume_id = st.text_input("バッチID", placeholder="batch_...").strip()
+        if st.button("追加", disabled=not resume_id) and resume_id not in st.session_state.pending_batches:
+            try:
+                batch = client.batches.retrieve(resume_id)
+                st.session_state.pending_batches[resume_id] = {
+                    'count': batch.request_counts.total,
+                    'submitted_at': batch.created_at
+                }
+            except Exception as e:
+                st.error(f"エラーが発生しました: {str(e)}")
+
+    for batch_id, pending in list(st.session_state.pending_batches.items()):
+        st.info(f"⏳ バッチ処理を実行中です（{pending['count']}枚、ID: {batch_id}）")
+
+        if st.button("🔄 バッチ処理の状態を確認", key=f"check_{batch_id}"):
+            try:
+                collected = collect_batch(client, batch_id)
+
+                if collected is None:
+                    st.info("まだ完了していません。しばらくしてから再度確認してください。")
+                else:
+                    results, truncated = collected
+                    del st.session_state.pending_batches[batch_id]
+                    detected, new_count = _record_results(results, pending['submitted_at'])
+                    failed = sum(1 for names in results if names is None)
+
+                    st.success(f"✅ {len(results)}枚から{detected}人検出（新規: {new_count}人）")
+                    if failed:
+                        st.warning(f"{failed}枚の画像の解析に失敗しました。")
+                    _warn_truncated(truncated)
+
+            except RuntimeError as e:
+                # 失敗・期限切れのバッチは結果を受け取れないので破棄する
+                del st.session_state.pending_batches[batch_id]
+                st.error(f"エラーが発生しました: {str(e)}")
+            except Exception as e:
+                st.error(f"エラーが発生しました: {str(e)}")
 
     # 出席者リスト表示
     st.markdown("---")
-    st.subheader(f"📊 出席者リスト（{len(st.session_state.attendance_data)}人）")
-
-    if st.session_state.attendance_data:
-        # データフレーム作成
-        data = []
-        for name, times in sorted(st.session_state.attendance_data.items()):
-            data.append({
-                '名前': name,
-                '初回記録時刻': times[0] if times else "",
-                '記録回数': len(times)
-            })
+    summary = summarize(st.session_state.records) if st.session_state.records else None
+    st.subheader(f"📊 出席者リスト（{0 if summary is None else len(summary)}人）")
 
-        df = pd.DataFrame(data)
-        st.dataframe(df, use_container_width=True, hide_index=True)
+    if summary is not None:
+        st.dataframe(
+            summary.drop(columns='全記録時刻'),
+            use_container_width=True,
+            hide_index=True
+        )
 
         # ボタン行
         col1, col2 = st.columns(2)
 
         with col1:
             # CSVダウンロード
-            csv_data = []
-            for name, times in sorted(st.session_state.attendance_data.items()):
-                csv_data.append({
-                    '名前': name,
-                    '初回記録時刻': times[0] if times else "",
-                    '記録回数': len(times),
-                    '全記録時刻': "; ".join(times)
-                })
-
-            csv_df = pd.DataFrame(csv_data)
             csv_buffer = io.StringIO()
-            csv_df.to_csv(csv_buffer, index=False, encoding='utf-8-sig')
+            summary.to_csv(csv_buffer, index=False, encoding='utf-8-sig')
 
             now = datetime.now().strftime("%Y%m%d_%H%M%S")
             st.download_button(
@@ -199,7 +272,7 @@ def main():
 
         with col2:
             if st.button("🗑️ データをクリア", use_container_width=True):
-                st.session_state.attendance_data = {}
+                st.session_state.records = []
                 st.rerun()
     else:
         st.info("まだ出席者データがありません。スクリーンショットをアップロードして解析してください。")
@@ -1,19 +1,23 @@
 """
 Zoom出席自動カウントアプリ
-OpenAI GPT-4oを使用してZoomの参加者パネルから出席者を抽出
+OpenAI GPT-4o miniを使用してZoomの参加者パネルから出席者を抽出
 """
 
 import tkinter as tk
 from tkinter import ttk, messagebox, filedialog
-from PIL import ImageGrab, Image
-import csv
-import base64
-import io
+import bisect
 import os
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
+import mss
 from dotenv import load_dotenv
-from openai import OpenAI
+from _core import (
+    MAX_CONCURRENT_REQUESTS, MAX_RETRIES, REQUEST_TIMEOUT, TIME_FORMAT, NameCache,
+    extract_names, preprocess, summarize
+)
 
 
 # .envファイルを読み込む
@@ -21,17 +25,26 @@ ENV_FILE = Path(__file__).parent / ".env"
 load_dotenv(ENV_FILE)
 
 
+def _format_time(timestamp):
+    """UNIX時刻を表示用の文字列に変換"""
+    return datetime.fromtimestamp(timestamp).strftime(TIME_FORMAT)
+
+
 class ScreenSelector:
-    """画面範囲を選択するためのオーバーレイウィンドウ"""
+    """画面範囲を選択するためのオーバーレイウィンドウ
 
-    def __init__(self, callback):
-        self.callback = callback
+    ウィンドウは最初に一度だけ作成し、show()で表示して使い回す
+    """
+
+    def __init__(self, master):
+        self.callback = None
         self.start_x = None
         self.start_y = None
         self.rect = None
 
-        # フルスクリーンのオーバーレイを作成
-        self.root = tk.Toplevel()
+        # フルスクリーンのオーバーレイを作成（使うまで非表示）
+        self.root = tk.Toplevel(master)
+        self.root.withdraw()
         self.root.attributes('-fullscreen', True)
         self.root.attributes('-alpha', 0.3)
         self.root.attributes('-topmost', True)
@@ -47,6 +60,9 @@ class ScreenSelector:
         self.canvas.bind('<ButtonRelease-1>', self.on_release)
         self.root.bind('<Escape>', lambda e: self.cancel())
 
+        # ウィンドウを閉じられた場合も破棄せずキャンセル扱いにする
+        self.root.protocol('WM_DELETE_WINDOW', self.cancel)
+
         # 説明テキスト
         self.canvas.create_text(
             self.root.winfo_screenwidth() // 2,
@@ -56,6 +72,16 @@ class ScreenSelector:
             fill='white'
         )
 
+    def show(self, callback):
+        """オーバーレイを表示して範囲選択を開始"""
+        self.callback = callback
+        self.start_x = None
+        self.start_y = None
+
+        self.root.deiconify()
+        self.root.attributes('-fullscreen', True)
+        self.root.focus_force()
+
     def on_press(self, event):
         self.start_x = event.x
         self.start_y = event.y
@@ -85,12 +111,19 @@ class ScreenSelector:
             self.cancel()
             return
 
-        self.root.destroy()
-        self.callback((x1, y1, x2, y2))
+        self._finish((x1, y1, x2, y2))
 
     def cancel(self):
-        self.root.destroy()
-        self.callback(None)
+        self._finish(None)
+
+    def _finish(self, region):
+        """オーバーレイを隠して結果を通知"""
+        if self.rect:
+            self.canvas.delete(self.rect)
+            self.rect = None
+
+        self.root.withdraw()
+        self.callback(region)
 
 
 class ZoomAttendanceApp:
@@ -106,19 +139,47 @@ class ZoomAttendanceApp:
         self.client = None
         self._init_openai_client()
 
-        # 出席者データ: {名前: [記録時刻のリスト]}
-        self.attendance_data = {}
+        # 出席者データ: [(名前, UNIX時刻)]と名前ごとの記録回数
+        self._records = []
+        self._counts = Counter()
+
+        # リストビューの行: {名前: Treeviewのiid}、表示順（名前順）の名前リスト
+        self._tree_iids = {}
+        self._sorted_names = []
+
+        # 名前ごとの初回記録時刻（解析結果は順不同で届くので最小値を保持）
+        self._first_seen = {}
 
         # 選択した範囲を保存
         self.capture_region = None
 
+        # 画面キャプチャ（初期化コストが高いので使い回す）
+        self._sct = mss.mss()
+
+        # API呼び出し用のスレッドと、解析待ちの件数
+        self._pool = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS)
+        self._pending = 0
+        self._closing = False
+
+        # 解析結果のキャッシュ（同じ画像ならAPIを呼ばない）
+        self._name_cache = NameCache()
+
         self.setup_ui()
 
+        # 範囲選択用のオーバーレイ（選択のたびに作り直さないよう先に作っておく）
+        self._selector = ScreenSelector(self.root)
+
     def _init_openai_client(self):
         """OpenAIクライアントを初期化"""
         api_key = os.environ.get('OPENAI_API_KEY')
         if api_key:
-            self.client = OpenAI(api_key=api_key)
+            from openai import OpenAI
+
+            self.client = OpenAI(
+                api_key=api_key,
+                timeout=REQUEST_TIMEOUT,
+                max_retries=MAX_RETRIES
+            )
 
     def setup_ui(self):
         """UIを構築"""
@@ -225,7 +286,7 @@ class ZoomAttendanceApp:
 
     def _start_selection(self):
         """範囲選択を開始"""
-        ScreenSelector(self._on_region_selected)
+        self._selector.show(self._on_region_selected)
 
     def _on_region_selected(self, region):
         """範囲選択完了時のコールバック"""
@@ -249,7 +310,7 @@ class ZoomAttendanceApp:
             self._do_capture(self.capture_region)
 
     def _do_capture(self, region):
-        """実際のキャプチャとOCR処理"""
+        """画面をキャプチャしてOCR処理を開始"""
         try:
             # 画面キャプチャ
             self.status_var.set("キャプチャ中...")
@@ -257,110 +318,111 @@ class ZoomAttendanceApp:
 
             # 少し待ってからキャプチャ
             self.root.after(100)
-            screenshot = ImageGrab.grab(bbox=region)
+            x1, y1, x2, y2 = region
+            raw = self._sct.grab({'left': x1, 'top': y1, 'width': x2 - x1, 'height': y2 - y1})
+            from PIL import Image
 
-            # 画像をbase64エンコード
-            buffer = io.BytesIO()
-            screenshot.save(buffer, format='PNG')
-            image_base64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
+            screenshot = Image.frombytes('RGB', raw.size, raw.rgb)
 
-            # OpenAI APIで解析
-            self.status_var.set("AI解析中...")
-            self.root.update()
+            # 画像を縮小
+            jpeg_bytes = preprocess(screenshot)
+
+        except Exception as e:
+            messagebox.showerror("エラー", f"処理中にエラーが発生しました:\n{str(e)}")
+            self.status_var.set("エラーが発生しました")
+            return
 
-            names = self._extract_names_with_openai(image_base64)
+        now = time.time()
 
-            if not names:
-                self.status_var.set("参加者が検出されませんでした。範囲を調整してください。")
-                return
+        # OpenAI APIでの解析は別スレッドで行い、結果はメインスレッドで反映する
+        # （前回と同じ画像ならAPIを呼ばずにキャッシュが使われる）
+        self._pending += 1
+        self.status_var.set(f"AI解析中...（{self._pending}件）")
 
-            # 出席データに追加
-            now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            new_count = 0
-            for name in names:
-                if name not in self.attendance_data:
-                    self.attendance_data[name] = []
-                    new_count += 1
-                self.attendance_data[name].append(now)
+        future = self._pool.submit(extract_names, self.client, jpeg_bytes, self._name_cache)
+        future.add_done_callback(lambda f: self._on_future_done(f, now))
+
+    def _on_future_done(self, future, timestamp):
+        """API解析完了時のコールバック（ワーカースレッドで実行）"""
+        # 終了後に届いた結果は捨てる
+        if self._closing:
+            return
 
-            # リスト更新
-            self._update_list()
+        try:
+            self.root.after(0, self._on_names_ready, future, timestamp)
+        except (RuntimeError, tk.TclError):
+            # ウィンドウが破棄された直後に届いた場合
+            pass
 
-            self.status_var.set(f"検出: {len(names)}人（新規: {new_count}人）- {now}")
+    def _on_names_ready(self, future, timestamp):
+        """API解析完了時のコールバック（メインスレッドで実行）"""
+        self._pending -= 1
 
+        try:
+            names, truncated = future.result()
         except Exception as e:
             messagebox.showerror("エラー", f"処理中にエラーが発生しました:\n{str(e)}")
             self.status_var.set("エラーが発生しました")
+            return
 
-    def _extract_names_with_openai(self, image_base64):
-        """OpenAI GPT-4oで参加者名を抽出"""
-        response = self.client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": """この画像はZoomミーティングの参加者パネルのスクリーンショットです。
-参加者の名前のみを抽出してください。
-
-ルール:
-- 1行に1人の名前を出力
-- 名前の後ろにある「(ホスト)」「(自分)」「(me)」「(host)」などの表記は除去
-- 「ミュート」「ビデオ」などのUIボタンは無視
-- アイコンや絵文字は無視
-- 名前が読み取れない場合は出力しない
-
-出力形式（名前のみ、余計な説明は不要）:
-山田太郎
-John Smith
-..."""
-                        },
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/png;base64,{image_base64}"
-                            }
-                        }
-                    ]
-                }
-            ],
-            max_tokens=1000
-        )
+        self._record_names(names, timestamp, truncated)
 
-        # レスポンスから名前を抽出
-        text = response.choices[0].message.content.strip()
-        names = [line.strip() for line in text.split('\n') if line.strip()]
+    def _record_names(self, names, timestamp, truncated):
+        """検出した名前を出席データに追加"""
+        if not names:
+            self.status_var.set("参加者が検出されませんでした。範囲を調整してください。")
+            return
 
-        # 重複を除去しつつ順序を保持
-        seen = set()
-        unique_names = []
-        for name in names:
-            if name and name not in seen and len(name) >= 2:
-                seen.add(name)
-                unique_names.append(name)
+        new_count = sum(1 for name in names if name not in self._counts)
+        self._records.extend((name, timestamp) for name in names)
+        self._counts.update(names)
 
-        return unique_names
+        # リスト更新
+        self._update_list(names, timestamp)
 
-    def _update_list(self):
-        """リストビューを更新"""
-        # 既存のアイテムをクリア
-        for item in self.tree.get_children():
-            self.tree.delete(item)
+        status = f"検出: {len(names)}人（新規: {new_count}人）- {_format_time(timestamp)}"
+        if truncated:
+            status += "　※AIの出力が途中で切れたため、一部の参加者が欠けている可能性があります"
+        if self._pending:
+            status += f"　解析中: {self._pending}件"
+        self.status_var.set(status)
 
-        # データを追加
-        for name, times in sorted(self.attendance_data.items()):
-            first_time = times[0] if times else ""
-            count = len(times)
-            self.tree.insert('', tk.END, values=(name, first_time, count))
+    def _update_list(self, names, timestamp):
+        """リストビューを更新（指定した名前の行のみ）"""
+        for name in names:
+            count = self._counts[name]
+            iid = self._tree_iids.get(name)
+
+            if iid is None:
+                # 新しい名前は名前順の位置に挿入
+                index = bisect.bisect(self._sorted_names, name)
+                self._sorted_names.insert(index, name)
+                self._first_seen[name] = timestamp
+                self._tree_iids[name] = self.tree.insert(
+                    '', index, values=(name, _format_time(timestamp), count)
+                )
+            else:
+                self.tree.set(iid, 'count', count)
+
+                # 先に撮ったキャプチャの結果が後から届いた場合は初回記録時刻を直す
+                if timestamp < self._first_seen[name]:
+                    self._first_seen[name] = timestamp
+                    self.tree.set(iid, 'first_time', _format_time(timestamp))
 
         # 統計更新
-        self.stats_var.set(f"出席者: {len(self.attendance_data)}人")
+        self.stats_var.set(f"出席者: {len(self._counts)}人")
+
+    def _clear_list(self):
+        """リストビューを空にする"""
+        self.tree.delete(*self.tree.get_children())
+        self._tree_iids.clear()
+        self._sorted_names.clear()
+        self._first_seen.clear()
+        self.stats_var.set("出席者: 0人")
 
     def export_csv(self):
         """CSVファイルにエクスポート"""
-        if not self.attendance_data:
+        if not self._records:
             messagebox.showwarning("警告", "エクスポートするデータがありません")
             return
 
@@ -378,15 +440,7 @@ John Smith
             return
 
         try:
-            with open(filepath, 'w', newline='', encoding='utf-8-sig') as f:
-                writer = csv.writer(f)
-                writer.writerow(['名前', '初回記録時刻', '記録回数', '全記録時刻'])
-
-                for name, times in sorted(self.attendance_data.items()):
-                    first_time = times[0] if times else ""
-                    count = len(times)
-                    all_times = "; ".join(times)
-                    writer.writerow([name, first_time, count, all_times])
+            summarize(self._records).to_csv(filepath, index=False, encoding='utf-8-sig')
 
             messagebox.showinfo("完了", f"CSVファイルを保存しました:\n{filepath}")
             self.status_var.set(f"エクスポート完了: {filepath}")
@@ -396,17 +450,23 @@ John Smith
 
     def clear_data(self):
         """データをクリア"""
-        if not self.attendance_data:
+        if not self._records:
             return
 
         if messagebox.askyesno("確認", "すべての出席データをクリアしますか？"):
-            self.attendance_data.clear()
-            self._update_list()
+            self._records.clear()
+            self._counts.clear()
+            self._clear_list()
             self.status_var.set("データをクリアしました")
 
     def run(self):
         """アプリケーションを実行"""
-        self.root.mainloop()
+        try:
+            self.root.mainloop()
+        finally:
+            self._closing = True
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._sct.close()
 
 
 def main():